@@ -7,14 +7,22 @@ Despite using Python’s unittest, this is not a set of unit tests. The Python
 module is simply a nice low-overhead testing framework.
 '''
 
+import argparse
+import ast
 import codecs
+import collections
+import functools
+import hashlib
+import json
 import multiprocessing
 import os
 from pathlib import Path
 import re
+import shutil
 import subprocess as sp
 import sys
 import tempfile
+import traceback
 import unittest
 
 CPUS = multiprocessing.cpu_count()
@@ -25,33 +33,181 @@ MURPHI2XML_RNG = Path(__file__).resolve().parent / '../misc/murphi2xml.rng'
 # test configuration variables, set during main
 CONFIG = {}
 
+# number of test cases to run at once, set during main
+JOBS = CPUS
+
+# environment for commands we run, including our configuration, set during main
+ENV = None
+
+# exit status Valgrind uses to indicate it found an error
+VALGRIND_ERROR_EXIT = 42
+
+# command line prefix for running something under Valgrind
+VALGRIND_ARGS = ('valgrind', '--leak-check=full', '--show-leak-kinds=all',
+  '--error-exitcode={}'.format(VALGRIND_ERROR_EXIT),
+  '--child-silent-after-fork=yes')
+
+# prefix for commands to run under Valgrind, empty if it is unavailable, set
+# during main
+VALGRIND = []
+
+# tools the configuration scripts look for, beyond any CC and CXX we are given
+PROBED_TOOLS = ('c++', 'cc', 'cvc4', 'uclid', 'valgrind', 'xmllint', 'z3')
+
+# translators with test cases of their own
+TRANSLATORS = ('murphi2c', 'murphi2uclid', 'murphi2xml')
+
+# those of the above that are installed, set during main
+AVAILABLE_TRANSLATORS = set()
+
+# scratch directory for the lifetime of a test run, set during main
+TMP = None
+
+# names of the test cases requested on the command line, or None for all of
+# them, set during main
+SELECTED = None
+
+# directory within TMP for temporary files of the current process, set during
+# main and in each worker
+SCRATCH = None
+
+# a '-- rumur_flags: …' etc line in the leading comments of a test input
+DIRECTIVE_RE = re.compile(r'\s*--\s*(?P<key>[a-zA-Z_]\w*)\s*:(?P<value>.*)$')
+
+# test directives are expected to fit within this many leading bytes of a file,
+# though we read further when they do not
+HEADER_SIZE = 4096
+
+ISUNDEFINED_RE = re.compile(r'\bisundefined\b')
+PUT_RE = re.compile(r'\bput\b')
+
 def enc(s): return s.encode('utf-8', 'replace')
 def dec(s): return s.decode('utf-8', 'replace')
 
-def run(args, stdin = None):
+@functools.lru_cache(maxsize=None)
+def which(program):
+  '''
+  resolve a program name to a full path, if possible
+  '''
+  if os.path.dirname(program) != '':
+    return program
+  return shutil.which(program) or program
+
+def spawn(args, stdin = None, output = None):
+  '''
+  start a command, returning its process and the data to send to its input
+
+  stdin can be either text or bytes to send to the command or a file descriptor
+  to connect to its input. If output is given, the command’s stdout is written
+  to this file descriptor instead of being captured.
+  '''
+  data = None
+  if stdin is None or isinstance(stdin, (bytes, str)):
+    data = enc(stdin) if isinstance(stdin, str) else stdin
+    stdin = sp.PIPE
+  if output is None:
+    output = sp.PIPE
+  args = [str(a) for a in args]
+
+  # Python can only start the command with posix_spawn, rather than the more
+  # expensive fork and exec, if it is given a full path and need not close
+  # inherited file descriptors. Descriptors Python opens are non-inheritable by
+  # default, so the latter is safe.
+  args[0] = which(args[0])
+  p = sp.Popen(args, stdout=output, stderr=sp.PIPE, stdin=stdin, env=ENV,
+               close_fds=False)
+  return p, data
+
+def collect(p, data):
+  '''
+  wait for a command started by spawn and return its result
+
+  The command’s output is returned undecoded, to avoid the cost of decoding it
+  when it is unused.
+  '''
+  stdout, stderr = p.communicate(data)
+  if stdout is None:
+    stdout = b''
+  return p.returncode, stdout, stderr
+
+def run(args, stdin = None, output = None):
   '''
   run a command and return its result
   '''
-  if stdin is not None:
-    stdin = enc(stdin)
-  env = {k: v for k, v in os.environ.items()}
-  env.update({k: str(v) for k, v in CONFIG.items()})
-  p = sp.Popen([str(a) for a in args], stdout=sp.PIPE, stderr=sp.PIPE,
-               stdin=sp.PIPE, env=env)
-  stdout, stderr = p.communicate(stdin)
-  return p.returncode, dec(stdout), dec(stderr)
+  return collect(*spawn(args, stdin, output))
+
+def run_concurrently(*commands):
+  '''
+  run several independent (args, stdin) commands at once and return their
+  results in the same order
+
+  Each command is only sent its input once those before it have finished, so
+  commands should take their input from files to overlap fully.
+  '''
+  started = [spawn(*c) for c in commands]
+  return [collect(p, data) for p, data in started]
 
+@functools.lru_cache(maxsize=None)
+def read_header(src):
+  '''
+  read the leading lines of a test input, where directives may appear
+  '''
+  with open(str(src), 'rb') as f:
+    header = f.read(HEADER_SIZE)
+    lines = dec(header).splitlines()
+
+    # if we filled the buffer, the last line may have been truncated
+    if len(header) == HEADER_SIZE:
+      lines = lines[:-1]
+
+      # if every line we kept is a directive, more may follow, so fall back to
+      # the whole file
+      if all(DIRECTIVE_RE.match(l) is not None for l in lines):
+        lines = dec(header + f.read()).splitlines()
+
+  return tuple(lines)
+
+@functools.lru_cache(maxsize=None)
 def parse_test_options(src, debug = False, multithreaded = False, xml = False):
   '''
   extract test tweaks and directives from leading comments in a test input
+
+  The result is a tuple of (key, value) pairs, cached because the same input is
+  consulted by many test classes.
+  '''
+  options = []
+  for line in read_header(src):
+    # recognise '-- rumur_flags: …' etc lines
+    m = DIRECTIVE_RE.match(line)
+    if m is None:
+      break
+    value = m.group('value').strip()
+    try:
+      # most directives are plain literals
+      value = ast.literal_eval(value)
+    except (SyntaxError, ValueError):
+      # others are expressions that depend on the configuration or variant
+      value = eval(value, {'CONFIG': CONFIG, 're': re},
+                   {'debug': debug, 'multithreaded': multithreaded,
+                    'xml': xml})
+    options.append((m.group('key'), value))
+  return tuple(options)
+
+@functools.lru_cache(maxsize=None)
+def has_isundefined(src):
+  '''
+  does this test input use isundefined?
   '''
   with open(str(src), 'rt', encoding='utf-8') as f:
-    for line in f:
-      # recognise '-- rumur_flags: …' etc lines
-      m = re.match(r'\s*--\s*(?P<key>[a-zA-Z_]\w*)\s*:(?P<value>.*)$', line)
-      if m is None:
-        break
-      yield m.group('key'), eval(m.group('value').strip())
+    return ISUNDEFINED_RE.search(f.read()) is not None
+
+@functools.lru_cache(maxsize=None)
+def has_put(src):
+  '''
+  does this test input contain a put statement?
+  '''
+  with open(str(src), 'rt', encoding='utf-8') as f:
+    return PUT_RE.search(f.read()) is not None
 
 class executable(unittest.TestCase):
   '''
@@ -64,11 +220,10 @@ class executable(unittest.TestCase):
       '{} attached to executable class'.format(testcase)
 
     ret, stdout, stderr = run([testcase])
-    output = '{}{}'.format(stdout, stderr)
     if ret == 125:
-      self.skipTest(output.strip())
+      self.skipTest(dec(stdout + stderr).strip())
     elif ret != 0:
-      self.fail(output)
+      self.fail(dec(stdout + stderr))
 
 class murphi2c(unittest.TestCase):
   '''
@@ -77,30 +232,25 @@ class murphi2c(unittest.TestCase):
 
   def _run(self, testcase):
 
-    tweaks = {k: v for k, v in parse_test_options(testcase)}
+    tweaks = dict(parse_test_options(testcase))
 
     # there is no C equivalent of isundefined, because an implicit assumption in
     # the C representation is that you do not rely on undefined values
-    with open(str(testcase), 'rt', encoding='utf-8') as f:
-      should_fail = re.search(r'\bisundefined\b', f.read()) is not None
+    should_fail = has_isundefined(testcase)
 
     args = ['murphi2c', testcase]
-    if CONFIG['HAS_VALGRIND']:
-      args = ['valgrind', '--leak-check=full', '--show-leak-kinds=all',
-        '--error-exitcode=42'] + args
-    ret, stdout, stderr = run(args)
-    if CONFIG['HAS_VALGRIND']:
-      if ret == 42:
-        self.fail('Memory leak:\n{}{}'.format(stdout, stderr))
+    ret, stdout, stderr = run(VALGRIND + args)
+    if VALGRIND and ret == VALGRIND_ERROR_EXIT:
+      self.fail('Memory leak:\n{}{}'.format(dec(stdout), dec(stderr)))
 
     # if rumur was expected to reject this model, we allow murphi2c to fail
     if tweaks.get('rumur_exit_code', 0) == 0 and not should_fail and ret != 0:
       self.fail('Unexpected murphi2c exit status {}:\n{}{}'
-                .format(ret, stdout, stderr))
+                .format(ret, dec(stdout), dec(stderr)))
 
     if should_fail and ret == 0:
       self.fail('Unexpected murphi2c exit status {}:\n{}{}'
-                .format(ret, stdout, stderr))
+                .format(ret, dec(stdout), dec(stderr)))
 
     if ret != 0:
       return
@@ -110,7 +260,7 @@ class murphi2c(unittest.TestCase):
     ret, out, err = run(args, stdout)
     if ret != 0:
       self.fail('C compilation failed:\n{}{}\nProgram:\n{}'
-                .format(out, err, stdout))
+                .format(dec(out), dec(err), dec(stdout)))
 
 class murphi2cHeader(unittest.TestCase):
   '''
@@ -119,54 +269,61 @@ class murphi2cHeader(unittest.TestCase):
 
   def _run(self, testcase):
 
-    tweaks = {k: v for k, v in parse_test_options(testcase)}
+    tweaks = dict(parse_test_options(testcase))
 
     # there is no C equivalent of isundefined, because an implicit assumption in
     # the C representation is that you do not rely on undefined values
-    with open(str(testcase), 'rt', encoding='utf-8') as f:
-      should_fail = re.search(r'\bisundefined\b', f.read()) is not None
+    should_fail = has_isundefined(testcase)
 
     args = ['murphi2c', '--header', testcase]
-    if CONFIG['HAS_VALGRIND']:
-      args = ['valgrind', '--leak-check=full', '--show-leak-kinds=all',
-        '--error-exitcode=42'] + args
-    ret, stdout, stderr = run(args)
-    if CONFIG['HAS_VALGRIND']:
-      if ret == 42:
-        self.fail('Memory leak:\n{}{}'.format(stdout, stderr))
+    ret, stdout, stderr = run(VALGRIND + args)
+    if VALGRIND and ret == VALGRIND_ERROR_EXIT:
+      self.fail('Memory leak:\n{}{}'.format(dec(stdout), dec(stderr)))
 
     # if rumur was expected to reject this model, we allow murphi2c to fail
     if tweaks.get('rumur_exit_code', 0) == 0 and not should_fail and ret != 0:
       self.fail('Unexpected murphi2c exit status {}:\n{}{}'
-                .format(ret, stdout, stderr))
+                .format(ret, dec(stdout), dec(stderr)))
 
     if should_fail and ret == 0:
       self.fail('Unexpected murphi2c exit status {}:\n{}{}'
-                .format(ret, stdout, stderr))
+                .format(ret, dec(stdout), dec(stderr)))
 
     if ret != 0:
       return
 
-    with tempfile.TemporaryDirectory() as tmp:
-
-      # write the header to a temporary file
-      header = Path(tmp) / 'header.h'
-      with open(str(header), 'wt', encoding='utf-8') as f:
-        f.write(stdout)
-
-      # ask the C compiler if the header is valid
-      main_c = '#include "{}"\nint main(void) {{ return 0; }}\n'.format(header)
-      args = [CONFIG['CC']] + CONFIG['C_FLAGS'] + ['-o', os.devnull, '-']
-      ret, stdout, stderr = run(args, main_c)
-      if ret != 0:
-        self.fail('C compilation failed:\n{}{}'.format(stdout, stderr))
+    # write the header to a temporary file
+    header = SCRATCH / 'header.h'
+    with open(str(header), 'wb') as f:
+      f.write(stdout)
+
+    # write a program including the header to a file, so both compilers can
+    # read it at once
+    main_c = SCRATCH / 'main.c'
+    with open(str(main_c), 'wt', encoding='utf-8') as f:
+      f.write('#include "{}"\nint main(void) {{ return 0; }}\n'.format(header))
+
+    # if possible, have the compilers stop after checking the program rather
+    # than generating code we will discard
+    if CONFIG['HAS_SYNTAX_ONLY']:
+      output = ['-fsyntax-only']
+    else:
+      output = ['-o', os.devnull]
+
+    # ask the C and C++ compilers if the header is valid, in parallel
+    c_args = [CONFIG['CC']] + CONFIG['C_FLAGS'] + output + [main_c]
+    cxx_args = [CONFIG['CXX'], '-std=c++11'] + output + ['-x', 'c++', main_c,
+      '-Werror=format', '-Werror=sign-compare', '-Werror=type-limits']
+    c_result, cxx_result = run_concurrently((c_args,), (cxx_args,))
+
+    ret, stdout, stderr = c_result
+    if ret != 0:
+      self.fail('C compilation failed:\n{}{}'.format(dec(stdout), dec(stderr)))
 
-      # ask the C++ compiler if it is valid there too
-      ret, stdout, stderr = run([CONFIG['CXX'], '-std=c++11', '-o', os.devnull,
-        '-x', 'c++', '-', '-Werror=format', '-Werror=sign-compare',
-        '-Werror=type-limits'], main_c)
-      if ret != 0:
-        self.fail('C++ compilation failed:\n{}{}'.format(stdout, stderr))
+    ret, stdout, stderr = cxx_result
+    if ret != 0:
+      self.fail('C++ compilation failed:\n{}{}'
+                .format(dec(stdout), dec(stderr)))
 
 class murphi2uclid(unittest.TestCase):
   '''
@@ -175,7 +332,7 @@ class murphi2uclid(unittest.TestCase):
 
   def _run(self, testcase):
 
-    tweaks = {k: v for k, v in parse_test_options(testcase)}
+    tweaks = dict(parse_test_options(testcase))
 
     # test cases for which murphi2uclid is expected to fail
     MURPHI2UCLID_FAIL = (
@@ -301,13 +458,9 @@ class murphi2uclid(unittest.TestCase):
     )
 
     args = ['murphi2uclid', testcase]
-    if CONFIG['HAS_VALGRIND']:
-      args = ['valgrind', '--leak-check=full', '--show-leak-kinds=all',
-        '--error-exitcode=42'] + args
-    ret, stdout, stderr = run(args)
-    if CONFIG['HAS_VALGRIND']:
-      if ret == 42:
-        self.fail('Memory leak:\n{}{}'.format(stdout, stderr))
+    ret, stdout, stderr = run(VALGRIND + args)
+    if VALGRIND and ret == VALGRIND_ERROR_EXIT:
+      self.fail('Memory leak:\n{}{}'.format(dec(stdout), dec(stderr)))
 
     # if rumur was expected to reject this model, we allow murphi2uclid to fail
     should_fail = testcase.name in MURPHI2UCLID_FAIL
@@ -315,11 +468,11 @@ class murphi2uclid(unittest.TestCase):
 
     if not could_fail and ret != 0:
       self.fail('Unexpected murphi2uclid exit status {}:\n{}{}'
-                .format(ret, stdout, stderr))
+                .format(ret, dec(stdout), dec(stderr)))
 
     if should_fail and ret == 0:
       self.fail('Unexpected murphi2uclid exit status {}:\n{}{}'
-                .format(ret, stdout, stderr))
+                .format(ret, dec(stdout), dec(stderr)))
 
     if ret != 0:
       return
@@ -328,19 +481,18 @@ class murphi2uclid(unittest.TestCase):
     if not CONFIG['HAS_UCLID']:
       self.skipTest('uclid not available for validation')
 
-    with tempfile.TemporaryDirectory() as tmp:
-
-      # write the Uclid5 source to a temporary file
-      src = Path(tmp) / 'source.ucl'
-      with open(str(src), 'wt', encoding='utf-8') as f:
-        f.write(stdout)
+    # write the Uclid5 source to a temporary file
+    src = SCRATCH / 'source.ucl'
+    with open(str(src), 'wb') as f:
+      f.write(stdout)
 
-      # ask Uclid if the source is valid
-      ret, stdout, stderr = run(['uclid', src])
-      if testcase.name in UCLID_FAIL and ret == 0:
-        self.fail('uclid unexpectedly succeeded:\n{}{}'.format(stdout, stderr))
-      if testcase.name not in UCLID_FAIL and ret != 0:
-        self.fail('uclid failed:\n{}{}'.format(stdout, stderr))
+    # ask Uclid if the source is valid
+    ret, stdout, stderr = run(['uclid', src])
+    if testcase.name in UCLID_FAIL and ret == 0:
+      self.fail('uclid unexpectedly succeeded:\n{}{}'
+                .format(dec(stdout), dec(stderr)))
+    if testcase.name not in UCLID_FAIL and ret != 0:
+      self.fail('uclid failed:\n{}{}'.format(dec(stdout), dec(stderr)))
 
 class murphi2xml(unittest.TestCase):
   '''
@@ -349,21 +501,17 @@ class murphi2xml(unittest.TestCase):
 
   def _run(self, testcase):
 
-    tweaks = {k: v for k, v in parse_test_options(testcase)}
+    tweaks = dict(parse_test_options(testcase))
 
     args = ['murphi2xml', testcase]
-    if CONFIG['HAS_VALGRIND']:
-      args = ['valgrind', '--leak-check=full', '--show-leak-kinds=all',
-        '--error-exitcode=42'] + args
-    ret, stdout, stderr = run(args)
-    if CONFIG['HAS_VALGRIND']:
-      if ret == 42:
-        self.fail('Memory leak:\n{}{}'.format(stdout, stderr))
+    ret, stdout, stderr = run(VALGRIND + args)
+    if VALGRIND and ret == VALGRIND_ERROR_EXIT:
+      self.fail('Memory leak:\n{}{}'.format(dec(stdout), dec(stderr)))
 
     # if rumur was expected to reject this model, we allow murphi2xml to fail
     if tweaks.get('rumur_exit_code', 0) == 0 and ret != 0:
       self.fail('Unexpected murphi2xml exit status {}:\n{}{}'
-                .format(ret, stdout, stderr))
+                .format(ret, dec(stdout), dec(stderr)))
 
     if ret != 0:
       return
@@ -379,80 +527,154 @@ class murphi2xml(unittest.TestCase):
     ret, stdout, stderr = run(['xmllint', '--relaxng', MURPHI2XML_RNG,
       '--noout', '-'], xmlcontent)
     if ret != 0:
-      self.fail('Failed to validate:\n{}{}'.format(stdout, stderr))
+      self.fail('Failed to validate:\n{}{}'.format(dec(stdout), dec(stderr)))
+
+# configurations in which to test rumur, as (debug, optimised, multithreaded,
+# xml)
+RUMUR_CONFIGURATIONS = (
+  (False, False, False, False),
+  (True,  False, False, False),
+  (False, True,  False, False),
+  (True,  True,  False, False),
+  (False, False, True,  False),
+  (True,  False, True,  False),
+  (False, True,  True,  False),
+  (True,  True,  True,  False),
+  (False, False, False, True),
+  (False, True,  False, True),
+  (False, False, True,  True),
+  (False, True,  True,  True),
+)
+
+# the most recently generated checker, as (arguments, result), retained because
+# the test runner schedules test cases that share one back to back
+CHECKER = None
+
+def generate_checker(testcase, debug, multithreaded, xml):
+  '''
+  run rumur to generate C source for a checker
+
+  Whether the checker will be optimised does not affect its source, so this is
+  shared between the test cases for each setting. The source is written
+  directly to a file, a descriptor for which is returned alongside rumur’s
+  result.
+  '''
+  global CHECKER
+
+  key = (testcase, debug, multithreaded, xml)
+  if CHECKER is not None:
+    if CHECKER[0] == key:
+      return CHECKER[1]
+    os.close(CHECKER[1][3])
+    CHECKER = None
+
+  tweaks = dict(parse_test_options(testcase, debug, multithreaded, xml))
+
+  # keep the generated source in memory if we can, so it can be handed to the C
+  # compiler without touching the file system, or otherwise in the single file
+  # our scratch directory has for it
+  try:
+    model_c = os.memfd_create('model.c')
+  except (AttributeError, OSError):
+    model_c = os.open(str(SCRATCH / 'model.c'),
+                      os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+
+  # build up arguments to call rumur
+  args = ['rumur', '--output', '/dev/stdout', testcase]
+  if debug: args += ['--debug']
+  if xml: args += ['--output-format', 'machine-readable']
+  if multithreaded:
+    # share the CPUs between checkers that may be running at once, while still
+    # using enough threads to exercise multithreading
+    threads = max(2, CPUS // JOBS)
+    if threads != CPUS: args += ['--threads', str(threads)]
+  else: args += ['--threads', '1']
+  args += tweaks.get('rumur_flags', [])
+
+  try:
+    ret, stdout, stderr = run(VALGRIND + args, output=model_c)
+  except:
+    os.close(model_c)
+    raise
+
+  CHECKER = (key, (ret, stdout, stderr, model_c))
+  return CHECKER[1]
 
 class rumur(unittest.TestCase):
   '''
   test cases involving generating a checker and running it
   '''
 
+  # test case and (debug, optimised, multithreaded, xml) configuration for each
+  # generated test method
+  variants = {}
+
+  def batch_key(self):
+    '''
+    identify test cases that can share a generated checker
+    '''
+    testcase, (debug, _, multithreaded, xml) = \
+      self.variants[self._testMethodName]
+    return testcase, debug, multithreaded, xml
+
+  def exclusive(self):
+    '''
+    should this test case run alone, rather than alongside others?
+    '''
+    # SMT solvers can time out when competing with other tests for CPUs
+    testcase, (debug, _, multithreaded, xml) = \
+      self.variants[self._testMethodName]
+    tweaks = dict(parse_test_options(testcase, debug, multithreaded, xml))
+    return '--smt-path' in (tweaks.get('rumur_flags') or [])
+
   def _run_param(self, testcase, debug, optimised, multithreaded, xml):
 
-    tweaks = {k: v for k, v in parse_test_options(testcase, debug,
-      multithreaded, xml)}
+    tweaks = dict(parse_test_options(testcase, debug, multithreaded, xml))
 
     if tweaks.get('skip_reason') is not None:
       self.skipTest(tweaks['skip_reason'])
 
-    # build up arguments to call rumur
-    args = ['rumur', '--output', '/dev/stdout', testcase]
-    if debug: args += ['--debug']
-    if xml: args += ['--output-format', 'machine-readable']
-    if multithreaded and CPUS == 1: args +=['--threads', '2']
-    elif not multithreaded: args += ['--threads', '1']
-    args += tweaks.get('rumur_flags', [])
-
-    if CONFIG['HAS_VALGRIND']:
-      args = ['valgrind', '--leak-check=full', '--show-leak-kinds=all',
-        '--error-exitcode=42'] + args
-
     # call rumur
-    ret, stdout, stderr = run(args)
-    if CONFIG['HAS_VALGRIND']:
-      if ret == 42:
-        self.fail('Memory leak:\n{}{}'.format(stdout, stderr))
+    ret, stdout, stderr, model_c = generate_checker(testcase, debug,
+      multithreaded, xml)
+    if VALGRIND and ret == VALGRIND_ERROR_EXIT:
+      self.fail('Memory leak:\n{}{}'.format(dec(stdout), dec(stderr)))
     if ret != tweaks.get('rumur_exit_code', 0):
-      self.fail('Rumur failed:\n{}{}'.format(stdout, stderr))
+      self.fail('Rumur failed:\n{}{}'.format(dec(stdout), dec(stderr)))
 
     # if we expected to fail, we are done
     if ret != 0: return
 
-    model_c = stdout
-
-    with tempfile.TemporaryDirectory() as tmp:
+    # build up arguments to call the C compiler
+    model_bin = SCRATCH / 'model.exe'
+    args = [CONFIG['CC']] + CONFIG['C_FLAGS']
+    if optimised: args += ['-O3']
+    args += ['-o', model_bin, '-', '-lpthread']
 
-      # build up arguments to call the C compiler
-      model_bin = Path(tmp) / 'model.exe'
-      args = [CONFIG['CC']] + CONFIG['C_FLAGS']
-      if optimised: args += ['-O3']
-      args += ['-o', model_bin, '-', '-lpthread']
+    if CONFIG['NEEDS_LIBATOMIC']:
+      args += ['-latomic']
 
-      if CONFIG['NEEDS_LIBATOMIC']:
-        args += ['-latomic']
-
-      # call the C compiler
-      ret, stdout, stderr = run(args, model_c)
-      if ret != 0:
-        self.fail('C compilation failed:\n{}{}'.format(stdout, stderr))
+    # call the C compiler, reading the source from the start
+    os.lseek(model_c, 0, os.SEEK_SET)
+    ret, stdout, stderr = run(args, model_c)
+    if ret != 0:
+      self.fail('C compilation failed:\n{}{}'.format(dec(stdout), dec(stderr)))
 
-      # now run the model itself
-      ret, stdout, stderr = run([model_bin])
-      if ret != tweaks.get('checker_exit_code', 0):
-        self.fail('Unexpected checker exit status {}:\n{}{}'
-                  .format(ret, stdout, stderr))
+    # now run the model itself
+    ret, stdout, stderr = run([model_bin])
+    if ret != tweaks.get('checker_exit_code', 0):
+      self.fail('Unexpected checker exit status {}:\n{}{}'
+                .format(ret, dec(stdout), dec(stderr)))
 
     # if the test has a stdout expectation, check that now
     if tweaks.get('checker_output') is not None:
-      if tweaks['checker_output'].search(stdout) is None:
+      if tweaks['checker_output'].search(dec(stdout)) is None:
         self.fail('Checker output did not match expectation regex:\n{}{}'
-                  .format(stdout, stderr))
+                  .format(dec(stdout), dec(stderr)))
 
     # coarse grained check for whether the model contains a 'put' statement that
     # could screw up XML validation
-    with open(str(testcase), 'rt', encoding='utf-8') as f:
-      has_put = re.search(r'\bput\b', f.read()) is not None
-
-    if xml and not has_put:
+    if xml and not has_put(testcase):
 
       model_xml = stdout
 
@@ -463,70 +685,303 @@ class rumur(unittest.TestCase):
       ret, stdout, stderr = run(args, model_xml)
       if ret != 0:
         self.fail('Failed to XML-validate machine reachable output:\n{}{}'
-                  .format(stdout, stderr))
+                  .format(dec(stdout), dec(stderr)))
 
-class rumurSingleThreaded(rumur):
-  def _run(self, testcase):
-    self._run_param(testcase, False, False, False, False)
+def make_name(t):
+  '''
+  name mangle a path into a valid test case name
+  '''
+  safe_name = re.sub(r'[^a-zA-Z0-9]', '_', t.name)
+  return 'test_{}'.format(safe_name)
 
-class rumurDebugSingleThreaded(rumur):
-  def _run(self, testcase):
-    self._run_param(testcase, True, False, False, False)
+def register(names = None):
+  '''
+  discover test inputs and attach a test case method for each to our classes
 
-class rumurOptimisedSingleThreaded(rumur):
-  def _run(self, testcase):
-    self._run_param(testcase, False, True, False, False)
+  If names is given, only the test cases it selects, by either class name or
+  class and method name, are attached.
+  '''
 
-class rumurDebugOptimisedSingleThreaded(rumur):
-  def _run(self, testcase):
-    self._run_param(testcase, True, True, False, False)
+  def selected(cls, name):
+    if names is None: return True
+    return cls.__name__ in names or '{}.{}'.format(cls.__name__, name) in names
 
-class rumurMultithreaded(rumur):
-  def _run(self, testcase):
-    self._run_param(testcase, False, False, True, False)
+  # find files in our directory, learning which are directories without a stat
+  # call each where possible
+  root = str(Path(__file__).parent)
+  try:
+    listing = [(e.name, e.is_dir()) for e in os.scandir(root)]
+  except AttributeError: # Python < 3.5
+    listing = [(f, os.path.isdir(os.path.join(root, f)))
+               for f in os.listdir(root)]
 
-class rumurDebugMultithreaded(rumur):
-  def _run(self, testcase):
-    self._run_param(testcase, True, False, True, False)
+  us = os.path.basename(__file__)
+  for filename, is_dir in sorted(listing):
 
-class rumurOptimisedMultithreaded(rumur):
-  def _run(self, testcase):
-    self._run_param(testcase, False, True, True, False)
+    # skip directories and ourselves
+    if is_dir or filename == us: continue
 
-class rumurDebugOptimisedMultithreaded(rumur):
-  def _run(self, testcase):
-    self._run_param(testcase, True, True, True, False)
+    # skip anything that is neither an executable nor a model
+    path = os.path.join(root, filename)
+    is_executable = os.access(path, os.X_OK)
+    if not is_executable and not filename.endswith('.m'): continue
 
-class rumurSingleThreadedXML(rumur):
-  def _run(self, testcase):
-    self._run_param(testcase, False, False, False, True)
+    p = Path(path)
+    name = make_name(p)
 
-class rumurOptimisedSingleThreadedXML(rumur):
-  def _run(self, testcase):
-    self._run_param(testcase, False, True, False, True)
+    # if this is executable, treat it as a test case
+    if is_executable and selected(executable, name):
+      assert not hasattr(executable, name), \
+        'name collision involving executable.{}'.format(name)
+      setattr(executable, name, lambda self, p=p: self._run(p))
 
-class rumurMultithreadedXML(rumur):
-  def _run(self, testcase):
-    self._run_param(testcase, False, False, True, True)
+    # if this is not a model, skip the remaining generic logic
+    if p.suffix != '.m': continue
 
-class rumurOptimisedMultithreadedXML(rumur):
-  def _run(self, testcase):
-    self._run_param(testcase, False, True, True, True)
+    for params in RUMUR_CONFIGURATIONS:
+      variant = '{}_d{:d}o{:d}m{:d}x{:d}'.format(name, *params)
+      if not selected(rumur, variant): continue
+      assert not hasattr(rumur, variant), \
+        'name collision involving rumur.{}'.format(variant)
+      rumur.variants[variant] = (p, params)
+      setattr(rumur, variant,
+        lambda self, p=p, params=params: self._run_param(p, *params))
+
+    if 'murphi2c' in AVAILABLE_TRANSLATORS and selected(murphi2c, name):
+      assert not hasattr(murphi2c, name), \
+        'name collision involving murphi2c.{}'.format(name)
+      setattr(murphi2c, name, lambda self, p=p: self._run(p))
+
+    if 'murphi2c' in AVAILABLE_TRANSLATORS and selected(murphi2cHeader, name):
+      assert not hasattr(murphi2cHeader, name), \
+        'name collision involving murphi2cHeader.{}'.format(name)
+      setattr(murphi2cHeader, name, lambda self, p=p: self._run(p))
+
+    if 'murphi2uclid' in AVAILABLE_TRANSLATORS and selected(murphi2uclid, name):
+      assert not hasattr(murphi2uclid, name), \
+        'name collision involving murphi2uclid.{}'.format(name)
+      setattr(murphi2uclid, name, lambda self, p=p: self._run(p))
+
+    if 'murphi2xml' in AVAILABLE_TRANSLATORS and selected(murphi2xml, name):
+      assert not hasattr(murphi2xml, name), \
+        'name collision involving murphi2xml.{}'.format(name)
+      setattr(murphi2xml, name, lambda self, p=p: self._run(p))
+
+def configure():
+  '''
+  derive settings that are invariant for a test run from our configuration
+  '''
+  global ENV, VALGRIND, AVAILABLE_TRANSLATORS
 
-def make_name(t):
+  # environment for running commands, exposing our configuration
+  ENV = dict(os.environ)
+  ENV.update({k: str(v) for k, v in CONFIG.items()})
+
+  if CONFIG['HAS_VALGRIND']:
+    VALGRIND = list(VALGRIND_ARGS)
+
+  # there is no point running tests for a translator that is not installed, as
+  # they would all fail
+  AVAILABLE_TRANSLATORS = {t for t in TRANSLATORS
+                           if shutil.which(t, path=ENV.get('PATH')) is not None}
+
+def _init(config, tmp, selected, jobs):
   '''
-  name mangle a path into a valid test case name
+  setup a worker process in the test pool
   '''
-  safe_name = re.sub(r'[^a-zA-Z0-9]', '_', t.name)
-  return 'test_{}'.format(safe_name)
+  global JOBS, TMP, SCRATCH
+  JOBS = jobs
+  TMP = tmp
+  SCRATCH = Path(tempfile.mkdtemp(dir=TMP))
 
-def main():
+  # if this worker was forked, it has inherited our configuration and test
+  # cases already
+  if len(CONFIG) > 0: return
 
-  # setup stdout to make encoding errors non-fatal
-  sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer, 'replace')
+  CONFIG.update(config)
+  configure()
+  register(selected)
 
-  # parse configuration
-  global CONFIG
+def _run_batch(job):
+  '''
+  run an (index, batch) of (class name, method name) test cases within a worker
+  process
+
+  The index is returned with the outcome of each test case, as a list of (kind,
+  detail) pairs, where detail is the already-formatted traceback or skip reason.
+  '''
+  index, batch = job
+  outcomes = []
+  for cls, name in batch:
+    try:
+      test = globals()[cls](name)
+      result = unittest.TestResult()
+      test.run(result)
+    except Exception:
+      # report this as an error in the test case, rather than losing the rest of
+      # the batch
+      outcomes.append([('error', traceback.format_exc())])
+      continue
+
+    outcome = [('failure', detail) for _, detail in result.failures]
+    outcome += [('error', detail) for _, detail in result.errors]
+    outcome += [('skip', reason) for _, reason in result.skipped]
+    outcomes.append(outcome)
+  return index, outcomes
+
+class RemoteError(Exception):
+  '''
+  a failure or error that was formatted in a worker process
+  '''
+  pass
+
+class ParallelResult(unittest.TextTestResult):
+  '''
+  test result that can record outcomes from worker processes
+  '''
+
+  def _exc_info_to_string(self, err, test):
+    if isinstance(err[1], RemoteError):
+      return str(err[1])
+    return super()._exc_info_to_string(err, test)
+
+class ParallelSuite:
+  '''
+  wrapper for running a test suite in batches, across a pool of worker
+  processes
+  '''
+
+  def __init__(self, suite, jobs):
+    self.suite = suite
+    self.jobs = jobs
+
+  def __call__(self, result):
+
+    # test cases unittest failed to load are not of a class a worker could
+    # find, so run them here, as well as those that should run alone, which we
+    # leave until the workers are finished
+    local, remote, exclusive = [], [], []
+    for batch in batches(self.suite):
+      if any(getattr(t, 'exclusive', lambda: False)() for t in batch):
+        exclusive.append(batch)
+      elif self.jobs > 1 and all(globals().get(type(t).__name__) is type(t)
+                                 for t in batch):
+        remote.append(batch)
+      else:
+        local.append(batch)
+
+    if not self._run_locally(local, result) and len(remote) > 0:
+      self._run_remotely(remote, result)
+
+    if not result.shouldStop:
+      self._run_locally(exclusive, result)
+
+    return result
+
+  def _run_locally(self, todo, result):
+    '''
+    run batches of test cases in this process, returning whether to stop
+    '''
+    for batch in todo:
+      for test in batch:
+        test(result)
+        if result.shouldStop:
+          return True
+    return False
+
+  def _run_remotely(self, remote, result):
+    '''
+    run batches of test cases across a pool of worker processes
+    '''
+    with multiprocessing.Pool(self.jobs, _init,
+                              (CONFIG, TMP, SELECTED, self.jobs)) as pool:
+
+      jobs = [(i, [(type(t).__name__, t._testMethodName) for t in batch])
+              for i, batch in enumerate(remote)]
+
+      for i, outcomes in pool.imap_unordered(_run_batch, jobs):
+        for test, outcome in zip(remote[i], outcomes):
+          result.startTest(test)
+          for kind, detail in outcome:
+            if kind == 'failure':
+              result.addFailure(test, (RemoteError, RemoteError(detail), None))
+            elif kind == 'error':
+              result.addError(test, (RemoteError, RemoteError(detail), None))
+            else:
+              result.addSkip(test, detail)
+          if len(outcome) == 0:
+            result.addSuccess(test)
+          result.stopTest(test)
+
+        # leaving the pool terminates any outstanding work
+        if result.shouldStop:
+          break
+
+def flatten(suite):
+  '''
+  yield the individual test cases within a (possibly nested) test suite
+  '''
+  for t in suite:
+    if isinstance(t, unittest.TestSuite):
+      yield from flatten(t)
+    else:
+      yield t
+
+def batches(suite):
+  '''
+  group the test cases within a test suite into batches to be run together
+  '''
+  # keep the batches in the order of their first test, which plain dicts do
+  # not guarantee before Python 3.7
+  groups = collections.OrderedDict()
+  for test in flatten(suite):
+    key = test.batch_key() if hasattr(test, 'batch_key') else test.id()
+    groups.setdefault(key, []).append(test)
+  return list(groups.values())
+
+class ParallelRunner(unittest.TextTestRunner):
+  '''
+  test runner that distributes test cases across a pool of processes
+  '''
+
+  resultclass = ParallelResult
+
+  def run(self, test):
+    return super().run(ParallelSuite(test, JOBS))
+
+def job_count(value):
+  '''
+  parse a --jobs argument
+  '''
+  try:
+    n = int(value)
+  except ValueError:
+    n = 0
+  if n < 1:
+    raise argparse.ArgumentTypeError('invalid job count: {}'.format(value))
+  return n
+
+class TestProgram(unittest.TestProgram):
+  '''
+  command line test program that only generates the test cases requested
+  '''
+
+  def createTests(self, *args, **kwargs):
+    global SELECTED
+    if self.testNames is not None:
+      SELECTED = frozenset(self.testNames)
+    register(SELECTED)
+    super().createTests(*args, **kwargs)
+
+def load_config(use_cache):
+  '''
+  run the scripts in our config directory to determine test configuration
+
+  Results are saved to a file in the current (build) directory that can be
+  reused by later runs, provided the scripts, the environment variables they
+  depend on and the tools they find have not changed.
+  '''
+  probes = []
   for p in sorted((Path(__file__).parent / 'config').iterdir()):
 
     # skip subdirectories
@@ -535,63 +990,98 @@ def main():
     # skip non-executable files
     if not os.access(str(p), os.X_OK): continue
 
-    CONFIG[p.name] = eval(sp.check_output([str(p)]))
+    probes.append(p)
+
+  # derive a key for saved results from everything that may affect them
+  key = hashlib.sha256()
+  for p in probes:
+    key.update('{}\0{}\0'.format(p.name, p.stat().st_mtime_ns).encode())
+  for var in ('PATH', 'CC', 'CXX'):
+    key.update('{}\0'.format(os.environ.get(var, '')).encode())
+
+  # note where each tool is found and when it last changed, so installing,
+  # removing or upgrading one invalidates the results
+  tools = list(PROBED_TOOLS)
+  tools += [os.environ[v] for v in ('CC', 'CXX') if os.environ.get(v)]
+  for t in tools:
+    found = shutil.which(t)
+    try:
+      mtime = os.stat(found).st_mtime_ns
+    except (OSError, TypeError):
+      mtime = None
+    key.update('{}\0{}\0{}\0'.format(t, found, mtime).encode())
+  key = key.hexdigest()
+  cache = Path('rumur-tests-config.json')
+
+  if use_cache:
+    try:
+      with open(str(cache), 'rt', encoding='utf-8') as f:
+        # the results include commands we will run, so only trust them if
+        # nobody else could have written them
+        st = os.fstat(f.fileno())
+        if st.st_uid == os.getuid() and st.st_mode & 0o022 == 0:
+          saved = json.load(f)
+          if saved.get('key') == key:
+            return saved['config']
+    except (OSError, ValueError, KeyError, AttributeError):
+      pass
+
+  config = {}
+  for p in probes:
+    config[p.name] = ast.literal_eval(dec(sp.check_output([str(p)])))
+
+  # save the results, atomically so concurrent runs do not see a partial file,
+  # though failing to only costs the next run time
+  try:
+    fd, tmp = tempfile.mkstemp(dir='.', prefix='.rumur-tests-config-',
+                               suffix='.json')
+  except OSError:
+    return config
+  try:
+    with os.fdopen(fd, 'wt', encoding='utf-8') as f:
+      json.dump({'key': key, 'config': config}, f)
+    os.replace(tmp, str(cache))
+  except OSError:
+    os.unlink(tmp)
+
+  return config
 
-  # find files in our directory
-  root = Path(__file__).parent
-  for p in sorted(root.iterdir()):
+def main():
 
-    # skip directories
-    if p.is_dir(): continue
+  # setup stdout to make encoding errors non-fatal
+  sys.stdout = codecs.getwriter('utf-8')(sys.stdout.buffer, 'replace')
 
-    # skip ourselves
-    if os.path.samefile(str(p), __file__): continue
+  # parse our own options, leaving the remainder for unittest
+  parser = argparse.ArgumentParser(add_help=False,
+    usage='%(prog)s [options] [unittest options] [tests]')
+  parser.add_argument('--jobs', '-j', type=job_count, default=CPUS,
+    help='number of tests to run in parallel (default: {})'.format(CPUS))
+  parser.add_argument('--no-config-cache', action='store_false',
+    dest='config_cache', help='re-run configuration scripts, ignoring any '
+    'results saved by a previous run')
+  options, argv = parser.parse_known_args()
 
-    name = make_name(p)
+  # unittest will describe its own options and exit, so describe ours first
+  if '-h' in argv or '--help' in argv:
+    parser.print_help()
+    print()
 
-    # if this is executable, treat it as a test case
-    if os.access(str(p), os.X_OK):
-      assert not hasattr(executable, name), \
-        'name collision involving executable.{}'.format(name)
-      setattr(executable, name, lambda self, p=p: self._run(p))
+  global JOBS
+  JOBS = options.jobs
 
-    # if this is not a model, skip the remaining generic logic
-    if p.suffix != '.m': continue
+  # parse configuration
+  CONFIG.update(load_config(options.config_cache))
+
+  configure()
+
+  for t in TRANSLATORS:
+    if t not in AVAILABLE_TRANSLATORS:
+      sys.stderr.write('warning: {} not found; skipping its tests\n'.format(t))
 
-    for c in (rumurSingleThreaded,
-              rumurDebugSingleThreaded,
-              rumurOptimisedSingleThreaded,
-              rumurDebugOptimisedSingleThreaded,
-              rumurMultithreaded,
-              rumurDebugMultithreaded,
-              rumurOptimisedMultithreaded,
-              rumurDebugOptimisedMultithreaded,
-              rumurSingleThreadedXML,
-              rumurOptimisedSingleThreadedXML,
-              rumurMultithreadedXML,
-              rumurOptimisedMultithreadedXML,
-             ):
-      assert not hasattr(c, name), \
-        'name collision involving rumur.{}'.format(name)
-      setattr(c, name, lambda self, p=p: self._run(p))
-
-    assert not hasattr(murphi2c, name), \
-      'name collision involving murphi2c.{}'.format(name)
-    setattr(murphi2c, name, lambda self, p=p: self._run(p))
-
-    assert not hasattr(murphi2cHeader, name), \
-      'name collision involving murphi2cHeader.{}'.format(name)
-    setattr(murphi2cHeader, name, lambda self, p=p: self._run(p))
-
-    assert not hasattr(murphi2uclid, name), \
-      'name collision involving murphi2uclid.{}'.format(name)
-    setattr(murphi2uclid, name, lambda self, p=p: self._run(p))
-
-    assert not hasattr(murphi2xml, name), \
-      'name collision involving murphi2xml.{}'.format(name)
-    setattr(murphi2xml, name, lambda self, p=p: self._run(p))
-
-  unittest.main()
+  global TMP, SCRATCH
+  with tempfile.TemporaryDirectory() as TMP:
+    SCRATCH = Path(tempfile.mkdtemp(dir=TMP))
+    TestProgram(argv=sys.argv[:1] + argv, testRunner=ParallelRunner)
 
 if __name__ == '__main__':
   main()